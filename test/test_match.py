@@ -0,0 +1,110 @@
+"""
+Check the matching of `Yolov5Evaluator.match` and `match_unique`(numba) against
+the numpy matching of the baseline `process_batch`.
+    $ python -m pytest test/test_match.py
+"""
+
+import numpy as np
+import pytest
+import torch
+
+import yolov5.core.evaluator as evaluator
+from yolov5.core.evaluator import Yolov5Evaluator, argsort_descending, unique_first
+from yolov5.utils.metrics import _match_unique, match_unique
+
+IOUV = torch.linspace(0.5, 0.95, 10)
+
+
+def match_numpy(li, di, v, n, stable=False):
+    """The baseline matching, `stable` breaks ties by index descending instead of numpy's quicksort order."""
+    correct = np.zeros((n, IOUV.shape[0]), dtype=bool)
+    matches = np.stack((li, di, v), 1)  # [label, detection, iou]
+    if matches.shape[0] > 1:
+        matches = matches[matches[:, 2].argsort(kind="stable" if stable else "quicksort")[::-1]]
+        matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+        matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+    correct[matches[:, 1].astype(int)] = matches[:, 2:3] >= IOUV.numpy()
+    return correct
+
+
+def random_pairs(rng, nl, nd, ties=False):
+    """Candidate pairs of `nl` labels and `nd` detections, as `torch.where` of the iou matrix."""
+    iou = rng.uniform(0.3, 1.0, (nl, nd))
+    if ties:
+        iou = np.round(iou, 1)  # a few distinct values, lots of ties
+    iou = torch.from_numpy(iou.astype(np.float32))
+    x = torch.where((iou >= IOUV[0]) & torch.from_numpy(rng.random((nl, nd)) < 0.5))
+    return iou, x
+
+
+def match_torch(iou, x, monkeypatch):
+    monkeypatch.setattr(evaluator, "match_unique", None)  # the torch path
+    correct = torch.zeros(iou.shape[1], IOUV.shape[0], dtype=torch.bool)
+    return Yolov5Evaluator.match(None, iou, x, correct, IOUV).numpy()
+
+
+def match_kernel(kernel, iou, x):
+    v = iou[x].numpy()
+    return kernel(x[0].numpy(), x[1].numpy(), v, IOUV.numpy(), iou.shape[1])
+
+
+def test_unique_first():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        key = rng.integers(0, 10, rng.integers(1, 50))
+        np.testing.assert_array_equal(
+            unique_first(torch.from_numpy(key)).numpy(), np.unique(key, return_index=True)[1]
+        )
+
+
+def test_argsort_descending():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        x = np.round(rng.random(rng.integers(1, 50)), 1).astype(np.float32)
+        np.testing.assert_array_equal(
+            argsort_descending(torch.from_numpy(x)).numpy(), x.argsort(kind="stable")[::-1]
+        )
+
+
+@pytest.mark.parametrize("ties", [False, True])
+def test_match(ties, monkeypatch):
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        iou, x = random_pairs(rng, rng.integers(1, 10), rng.integers(1, 30), ties)
+        if not x[0].shape[0]:
+            continue
+        v = iou[x].numpy()
+        ref = match_numpy(x[0].numpy(), x[1].numpy(), v, iou.shape[1], stable=ties)
+        np.testing.assert_array_equal(match_torch(iou, x, monkeypatch), ref)
+
+
+def test_match_one_pair(monkeypatch):
+    iou = torch.tensor([[0.2, 0.7], [0.1, 0.3]])
+    x = (torch.tensor([0]), torch.tensor([1]))
+    ref = match_numpy(np.array([0]), np.array([1]), np.array([0.7]), 2)
+    np.testing.assert_array_equal(match_torch(iou, x, monkeypatch), ref)
+
+
+# the pure python kernel runs without numba
+kernels = [_match_unique] + ([] if match_unique is None else [match_unique])
+
+
+@pytest.mark.parametrize("kernel", kernels)
+@pytest.mark.parametrize("ties", [False, True])
+def test_match_unique(kernel, ties):
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        iou, x = random_pairs(rng, rng.integers(1, 10), rng.integers(1, 30), ties)
+        if not x[0].shape[0]:
+            continue
+        v = iou[x].numpy()
+        ref = match_numpy(x[0].numpy(), x[1].numpy(), v, iou.shape[1], stable=ties)
+        np.testing.assert_array_equal(match_kernel(kernel, iou, x), ref)
+
+
+@pytest.mark.parametrize("kernel", kernels)
+def test_match_unique_one_pair(kernel):
+    iou = torch.tensor([[0.2, 0.7], [0.1, 0.3]])
+    x = (torch.tensor([0]), torch.tensor([1]))
+    ref = match_numpy(np.array([0]), np.array([1]), np.array([0.7]), 2)
+    np.testing.assert_array_equal(match_kernel(kernel, iou, x), ref)
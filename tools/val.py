@@ -24,7 +24,7 @@ from yolov5.utils.checker import (
 def parse_opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--data', type=str, default='data/coco128.yaml', help='dataset.yaml path')
-    parser.add_argument('-w', '--weights', nargs='+', type=str, default='yolov5s.pt', help='model.pt path(s)')
+    parser.add_argument('-w', '--weights', nargs='+', type=str, default='yolov5s.pt', help='model.pt path(s) or model.engine')
     parser.add_argument('-b', '--batch-size', type=int, default=32, help='batch size')
     parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
     parser.add_argument('--conf-thres', type=float, default=0.001, help='confidence threshold')
@@ -42,6 +42,7 @@ def parse_opt():
     parser.add_argument('--name', default='exp', help='save to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--jit', action='store_true', help='trace model once with torch.jit.trace, evaluate with square batches')
     parser.add_argument('-m', "--mask", action="store_true", help="Whether to train the instance segmentation")
     # parser.add_argument("-mr", "--mask-ratio", type=int, default=1, help="Downsample ratio of the masks gt.")
 
@@ -68,6 +69,7 @@ def main(opt):
         half=opt.half,
         mask=opt.mask,
         nosave=opt.nosave,
+        jit=opt.jit,
         # mask_downsample_ratio=opt.mask_ratio
     )
 
@@ -7,16 +7,19 @@ Usage:
 """
 
 import json
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from threading import Thread
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from tqdm import tqdm
 
+from ..models.common import DetectMultiBackend
 from ..models.experimental import attempt_load
-from ..data import create_dataloader
+from ..data import create_dataloader, CUDAPrefetcher
 from ..utils.general import (
     coco80_to_coco91_class,
     increment_path,
@@ -39,39 +42,115 @@ from ..utils.segment import (
     mask_iou,
     process_mask,
     process_mask_upsample,
+    process_masks_batched,
 )
-from ..utils.metrics import ap_per_class, ap_per_class_box_and_mask, ConfusionMatrix
+from ..utils.metrics import ap_per_class, ap_per_class_box_and_mask, ConfusionMatrix, match_unique
 from ..utils.plots import output_to_target, plot_images_boxes_and_masks
-from ..utils.torch_utils import select_device, time_sync
+from ..utils.torch_utils import inference_mode, select_device, time_sync
+
+# plotting is cpu bound, run it in other processes rather than threads.
+_PLOT_POOL = None
+
+
+def plot_pool():
+    """Get the plotting processes, created on first use.
+    Workers are spawned rather than forked, forking a process holding a cuda context
+    and dataloader/tqdm threads could deadlock the child."""
+    global _PLOT_POOL
+    if _PLOT_POOL is None:
+        _PLOT_POOL = ProcessPoolExecutor(
+            max_workers=2, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _PLOT_POOL
+
+
+def plot_shutdown():
+    """Wait for the plots to be saved and release the plotting processes."""
+    global _PLOT_POOL
+    if _PLOT_POOL is not None:
+        _PLOT_POOL.shutdown(wait=True)
+        _PLOT_POOL = None
+
+
+def plot_done(fut):
+    # print the traceback of failed plotting, as the `Thread` did.
+    if not fut.cancelled() and fut.exception() is not None:
+        e = fut.exception()
+        traceback.print_exception(type(e), e, e.__traceback__)
 
 
 def save_one_txt(predn, save_conf, shape, file):
     # Save one txt result
-    gn = torch.tensor(shape)[[1, 0, 1, 0]]  # normalization gain whwh
-    for *xyxy, conf, cls in predn.tolist():
-        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-        with open(file, "a") as f:
-            f.write(("%g " * len(line)).rstrip() % line + "\n")
+    if not len(predn):
+        return
+    predn = predn[:, :6].float()
+    gn = torch.tensor(shape, device=predn.device)[[1, 0, 1, 0]]  # normalization gain whwh
+    xywh = (xyxy2xywh(predn[:, :4]) / gn).cpu().numpy()  # normalized xywh
+    cls = predn[:, 5:6].cpu().numpy()
+    lines = (cls, xywh, predn[:, 4:5].cpu().numpy()) if save_conf else (cls, xywh)  # label format
+    with open(file, "a") as f:
+        np.savetxt(f, np.concatenate(lines, 1), fmt="%g")
 
 
 def save_one_json(predn, jdict, path, class_map):
     # Save one JSON result {"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}
     image_id = int(path.stem) if path.stem.isnumeric() else path.stem
-    box = xyxy2xywh(predn[:, :4])  # xywh
+    p = predn[:, :6].detach().cpu().double().numpy()
+    box = xyxy2xywh(p[:, :4])  # xywh
     box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
-    for p, b in zip(predn.tolist(), box.tolist()):
-        jdict.append(
-            {
-                "image_id": image_id,
-                "category_id": class_map[int(p[5])],
-                "bbox": [round(x, 3) for x in b],
-                "score": round(p[4], 5),
-            }
-        )
+    box = np.round(box, 3)
+    scores = np.round(p[:, 4], 5)
+    cats = class_map[p[:, 5].astype(np.int32)].tolist()  # class_map is ndarray
+    jdict.extend(
+        {"image_id": image_id, "category_id": c, "bbox": b.tolist(), "score": float(s)}
+        for c, b, s in zip(cats, box, scores)
+    )
+
+
+def to_cpu_async(x):
+    """Copy `x` to pinned cpu memory without blocking, synchronize before reading the result."""
+    if x.device.type == "cpu":
+        return x
+    return torch.empty(x.shape, dtype=x.dtype, pin_memory=True).copy_(x, non_blocking=True)
+
+
+def pad_batch(img, bs):
+    """Pad `img` with zero images to the static batch size `bs`."""
+    n = img.shape[0]
+    if n < bs:
+        img = torch.cat((img, img.new_zeros(bs - n, *img.shape[1:])), 0)
+    return img
+
+
+def unique_first(key):
+    """Torch version of `np.unique(key, return_index=True)[1]`, index of the first occurrence of each value.
+    Arguments:
+        key (Array[K]), integer keys
+    Returns:
+        index (Array[U]), sorted by key
+    """
+    n = key.shape[0]
+    # make the sort stable, so that the first occurrence comes first
+    k = (key * n + torch.arange(n, device=key.device)).argsort()
+    key = key[k]
+    first = torch.ones_like(key, dtype=torch.bool)
+    first[1:] = key[1:] != key[:-1]
+    return k[first]
+
+
+def argsort_descending(x):
+    """Torch version of `np.argsort(x, kind="stable")[::-1]`, ties are ordered by index descending.
+    `sort(stable=True)` needs torch>=1.9, so values are ranked and ties broken by a composite key.
+    Arguments:
+        x (Array[K])
+    Returns:
+        index (Array[K])
+    """
+    n = x.shape[0]
+    _, rank = torch.unique(x, return_inverse=True)  # rank of every value, ascending
+    return (rank * n + torch.arange(n, device=x.device)).argsort(descending=True)
 
 
-@torch.no_grad()
 class Yolov5Evaluator:
     def __init__(
         self,
@@ -91,6 +170,7 @@ class Yolov5Evaluator:
         plots=True,
         mask=False,
         mask_downsample_ratio=1,
+        jit=False,
     ) -> None:
         self.data = check_dataset(data)  # check
         self.conf_thres = conf_thres  # confidence threshold
@@ -103,17 +183,23 @@ class Yolov5Evaluator:
         self.name = name  # save to project/name
         self.exist_ok = exist_ok  # existing project/name ok, do not increment
         self.half = half  # use FP16 half-precision inference
+        self.channels_last = False  # use channels_last memory format, set when model is ready
         self.save_dir = save_dir
         self.nosave = nosave
         self.plots = plots
         self.mask = mask
         self.mask_downsample_ratio = mask_downsample_ratio
+        self.jit = jit and not augment  # trace model with `torch.jit.trace` for `run`
+        self.jit_model = None  # traced once in `before_infer` with square batches
+        self.jit_batch_size = None  # batch size of the traced model
+        self.engine = False  # TensorRT engine, set when loading weights in `before_infer`
 
         self.nc = 1 if self.single_cls else int(self.data["nc"])  # number of classes
         self.iouv = torch.linspace(0.5, 0.95, 10)  # iou vector for mAP@0.5:0.95
         self.niou = self.iouv.numel()
         self.confusion_matrix = ConfusionMatrix(nc=self.nc)
         self.dt = [0.0, 0.0, 0.0]
+        self.scale_cache = {}  # (height, width, device): whwh gain for targets
         self.names = {k: v for k, v in enumerate(self.data["names"])}
         self.s = (
             ("%20s" + "%11s" * 10)
@@ -147,7 +233,9 @@ class Yolov5Evaluator:
         self.is_coco = isinstance(self.data.get("val"), str) and self.data["val"].endswith(
             "coco/val2017.txt"
         )  # COCO dataset
-        self.class_map = coco80_to_coco91_class() if self.is_coco else list(range(1000))
+        self.class_map = np.asarray(
+            coco80_to_coco91_class() if self.is_coco else list(range(1000)), dtype=np.int32
+        )  # ndarray for vectorized lookup
         self.jdict = []
         self.iou_thres = 0.65 if self.is_coco else self.iou_thres
 
@@ -156,56 +244,77 @@ class Yolov5Evaluator:
 
         # metric stuff
         self.seen = 0
-        self.stats = []
+        # stats are kept per field, (correct_masks, correct_boxes, conf, pcls, tcls).
+        self.reset_stats()
+        # per-image detections and labels of current batch, boxes are matched per batch.
+        self.batch_dets = []
+        self.batch_labels = []
+        self.batch_stats = []
         self.total_loss = torch.zeros((4 if self.mask else 3))
+        self.loss_chunks = []  # loss items of every batch, reduced once in `reduce_loss`
         self.metric = Metrics() if self.mask else Metric()
 
     def run_training(self, model, dataloader, compute_loss=None):
         """This is for evaluation when training."""
         self.seen = 0
         self.device = next(model.parameters()).device  # get model device
-        # self.iouv.to(self.device)
-        self.total_loss = torch.zeros((4 if self.mask else 3), device=self.device)
+        self.iouv = self.iouv.to(self.device)
+        self.jit = False  # weights are updated during training
+        self.loss_chunks = []
         self.half &= self.device.type != "cpu"  # half precision only supported on CUDA
         model.half() if self.half else model.float()
+        self.channels_last = (
+            self.device.type == "cuda" and torch.cuda.get_device_capability(self.device)[0] >= 7
+        )  # NHWC tensor core kernels, Volta and later
+        if self.channels_last:
+            model.to(memory_format=torch.channels_last)
         # Configure
         model.eval()
 
         # inference
         # masks will be `None` if training objection.
-        for batch_i, (img, targets, paths, shapes, masks) in enumerate(
-            tqdm(dataloader, desc=self.s)
-        ):
-            # reset pred_masks
-            self.pred_masks = []
-            img = img.to(self.device, non_blocking=True)
-            targets = targets.to(self.device)
-            if masks is not None:
-                masks = masks.to(self.device)
-            out, train_out = self.inference(model, img, targets, masks, compute_loss)
-
-            # Statistics per image
-            for si, pred in enumerate(out):
-                self.seen += 1
-                predn = pred.clone()
-
-                # NOTE
-                # I tested `compute_stat` and `compute_stat_native`,
-                # it shows the same results.
-                # but maybe I didn't do enough experiments,
-                # so I left the related code(`compute_stat_native`).
-                self.compute_stat(si, predn, targets, masks, train_out)
-                # shape = shapes[si][0]
-                # ratio_pad = shapes[si][1]
-                # self.compute_stat_native(si, img, predn, targets, masks, train_out, shape, ratio_pad)
-
-            self.plot_images(batch_i, img, targets, masks, out, paths)
+        if self.device.type != "cpu":
+            dataloader = CUDAPrefetcher(dataloader, self.device)
+        with inference_mode():
+            for batch_i, (img, targets, paths, shapes, masks) in enumerate(
+                tqdm(dataloader, desc=self.s)
+            ):
+                # reset pred_masks
+                self.pred_masks = []
+                img = img.to(self.device, non_blocking=True)
+                targets = targets.to(self.device)
+                if masks is not None:
+                    masks = masks.to(self.device)
+                out, train_out = self.inference(model, img, targets, masks, compute_loss)
+
+                # Statistics per image
+                labels, gt_masks = self.split_targets(targets, masks, len(out))
+                for si, pred in enumerate(out):
+                    self.seen += 1
+                    predn = pred.clone()
+
+                    # NOTE
+                    # I tested `compute_stat` and `compute_stat_native`,
+                    # it shows the same results.
+                    # but maybe I didn't do enough experiments,
+                    # so I left the related code(`compute_stat_native`).
+                    self.compute_stat(si, predn, labels[si], gt_masks[si])
+                    # shape = shapes[si][0]
+                    # ratio_pad = shapes[si][1]
+                    # self.compute_stat_native(si, img, predn, labels[si], gt_masks[si], train_out, shape, ratio_pad)
+                self.compute_batch_stat(masks, train_out)
+
+                self.plot_images(batch_i, img, targets, masks, out, paths)
 
         # compute map and print it.
         t = self.after_infer()
+        self.reduce_loss()
+        plot_shutdown()  # plots are saved when returning
 
         # Return results
         model.float()  # for training
+        if self.channels_last:
+            model.to(memory_format=torch.contiguous_format)
         return (
             (
                 *self.metric.mean_results(),
@@ -226,59 +335,65 @@ class Yolov5Evaluator:
         task="val",
     ):
         """This is for native evaluation."""
-        model, dataloader, imgsz = self.before_infer(weights, batch_size, imgsz, save_txt, task)
+        model, dataloader, batch_size, imgsz = self.before_infer(
+            weights, batch_size, imgsz, save_txt, task
+        )
         self.seen = 0
-        # self.iouv.to(self.device)
-        self.half &= self.device.type != "cpu"  # half precision only supported on CUDA
-        model.half() if self.half else model.float()
-        # Configure
-        model.eval()
+        self.loss_chunks = []
+        self.iouv = self.iouv.to(self.device)
 
         # inference
-        for batch_i, (img, targets, paths, shapes, masks) in enumerate(
-            tqdm(dataloader, desc=self.s)
-        ):
-            # reset pred_masks
-            self.pred_masks = []
-            img = img.to(self.device, non_blocking=True)
-            targets = targets.to(self.device)
-            if masks is not None:
-                masks = masks.to(self.device)
-            out, train_out = self.inference(model, img, targets, masks)
-
-            # Statistics per image
-            for si, pred in enumerate(out):
-                self.seen += 1
-                path = Path(paths[si])
-                predn = pred.clone()
-                shape = shapes[si][0]
-
-                # NOTE
-                # I tested `compute_stat` and `compute_stat_native`,
-                # it shows the same results.
-                # but maybe I didn't do enough experiments,
-                # so I left the related code(`compute_stat_native`).
-                self.compute_stat(si, predn, targets, masks, train_out)
-                # ratio_pad = shapes[si][1]
-                # self.compute_stat_native(si, img, predn, targets, masks, train_out, shape, ratio_pad)
-
-                # Save/log
-                if save_txt and self.save_dir.exists():
-                    save_one_txt(
-                        pred,
-                        save_conf,
-                        shape,
-                        file=self.save_dir / "labels" / (path.stem + ".txt"),
-                    )
-                if save_json and self.save_dir.exists():
-                    save_one_json(
-                        pred, self.jdict, path, self.class_map
-                    )  # append to COCO-JSON dictionary
-
-            self.plot_images(batch_i, img, targets, masks, out, paths)
+        if self.device.type != "cpu":
+            dataloader = CUDAPrefetcher(dataloader, self.device)
+        with inference_mode():
+            for batch_i, (img, targets, paths, shapes, masks) in enumerate(
+                tqdm(dataloader, desc=self.s)
+            ):
+                # reset pred_masks
+                self.pred_masks = []
+                img = img.to(self.device, non_blocking=True)
+                targets = targets.to(self.device)
+                if masks is not None:
+                    masks = masks.to(self.device)
+                out, train_out = self.inference(model, img, targets, masks)
+
+                # Statistics per image
+                labels, gt_masks = self.split_targets(targets, masks, len(out))
+                for si, pred in enumerate(out):
+                    self.seen += 1
+                    path = Path(paths[si])
+                    predn = pred.clone()
+                    shape = shapes[si][0]
+
+                    # NOTE
+                    # I tested `compute_stat` and `compute_stat_native`,
+                    # it shows the same results.
+                    # but maybe I didn't do enough experiments,
+                    # so I left the related code(`compute_stat_native`).
+                    self.compute_stat(si, predn, labels[si], gt_masks[si])
+                    # ratio_pad = shapes[si][1]
+                    # self.compute_stat_native(si, img, predn, labels[si], gt_masks[si], train_out, shape, ratio_pad)
+
+                    # Save/log
+                    if save_txt and self.save_dir.exists():
+                        save_one_txt(
+                            pred,
+                            save_conf,
+                            shape,
+                            file=self.save_dir / "labels" / (path.stem + ".txt"),
+                        )
+                    if save_json and self.save_dir.exists():
+                        save_one_json(
+                            pred, self.jdict, path, self.class_map
+                        )  # append to COCO-JSON dictionary
+                self.compute_batch_stat(masks, train_out)
+
+                self.plot_images(batch_i, img, targets, masks, out, paths)
 
         # compute map and print it.
         t = self.after_infer()
+        self.reduce_loss()
+        plot_shutdown()  # plots are saved when returning
 
         # Print speeds
         shape = (batch_size, 3, imgsz, imgsz)
@@ -305,7 +420,10 @@ class Yolov5Evaluator:
         )
 
     def before_infer(self, weights, batch_size, imgsz, save_txt, task="val"):
-        "prepare for evaluation without training."
+        """prepare for evaluation without training.
+        Return:
+            batch_size(int), imgsz(int): the ones actually used, TensorRT engine has static input shape.
+        """
         self.device = select_device(self.device, batch_size=batch_size)
 
         # Directories
@@ -318,16 +436,51 @@ class Yolov5Evaluator:
             )  # make dir
 
         # Load model
-        check_suffix(weights, ".pt")
-        model = attempt_load(weights, map_location=self.device)  # load FP32 model
-        gs = max(int(model.stride.max()), 32)  # grid size (max stride)
-        imgsz = check_img_size(imgsz, s=gs)  # check image size
+        check_suffix(weights, (".pt", ".engine"))
+        self.engine = str(weights[0] if isinstance(weights, list) else weights).endswith(".engine")
+        if self.engine:
+            # TensorRT engine has static input shape and only outputs boxes
+            assert not self.mask, "TensorRT engine does not support the evaluation of masks."
+            assert self.device.type == "cuda", "TensorRT engine requires a CUDA device."
+            model = DetectMultiBackend(weights, device=self.device)
+            batch_size, _, imgsz, _ = model.bindings["images"].shape
+            self.half = model.bindings["images"].dtype == np.float16  # the precision of engine
+            self.jit = False
+            gs = 32
+        else:
+            model = attempt_load(weights, map_location=self.device)  # load FP32 model
+            gs = max(int(model.stride.max()), 32)  # grid size (max stride)
+            imgsz = check_img_size(imgsz, s=gs)  # check image size
+
+        # Configure
+        self.half &= self.device.type != "cpu"  # half precision only supported on CUDA
+        model.half() if self.half else model.float()
+        self.channels_last = (
+            self.device.type == "cuda"
+            and torch.cuda.get_device_capability(self.device)[0] >= 7
+            and not self.engine
+        )  # NHWC tensor core kernels, Volta and later
+        if self.channels_last:
+            model.to(memory_format=torch.channels_last)
+        model.eval()
+
+        if (self.device.type != "cpu" or self.jit) and not self.engine:
+            with inference_mode():
+                model(
+                    torch.zeros(1, 3, imgsz, imgsz).to(self.device).type_as(next(model.parameters()))
+                )  # run once, also makes the grids of `Detect` before tracing
+        if self.jit:
+            # the grids of `Detect` are recorded as constants when tracing,
+            # so batches are square and the last one is padded to the traced shape.
+            img = torch.zeros(batch_size, 3, imgsz, imgsz, device=self.device)
+            img = img.half() if self.half else img
+            if self.channels_last:
+                img = img.to(memory_format=torch.channels_last)
+            with torch.no_grad():
+                self.jit_model = torch.jit.trace(model, img, strict=False)
+            self.jit_batch_size = batch_size
 
         # Data
-        if self.device.type != "cpu":
-            model(
-                torch.zeros(1, 3, imgsz, imgsz).to(self.device).type_as(next(model.parameters()))
-            )  # run once
         pad = 0.0 if task == "speed" else 0.5
         task = task if task in ("train", "val", "test") else "val"  # path to train/val/test images
         dataloader = create_dataloader(
@@ -337,32 +490,48 @@ class Yolov5Evaluator:
             gs,
             self.single_cls,
             pad=pad,
-            rect=True,
+            rect=not (self.engine or self.jit),  # static input shape
             prefix=colorstr(f"{task}: "),
             mask_head=self.mask,
             mask_downsample_ratio=self.mask_downsample_ratio,
         )[0]
-        return model, dataloader, imgsz
+        return model, dataloader, batch_size, imgsz
 
     def inference(self, model, img, targets, masks=None, compute_loss=None):
         """Inference"""
         t1 = time_sync()
         img = img.half() if self.half else img.float()  # uint8 to fp16/32
+        if self.channels_last:
+            img = img.to(memory_format=torch.channels_last)
         img /= 255.0  # 0 - 255 to 0.0 - 1.0
         _, _, height, width = img.shape  # batch size, channels, height, width
         t2 = time_sync()
         self.dt[0] += t2 - t1
 
         # Run model
-        out, train_out = model(img, augment=self.augment)  # inference and training outputs
+        if self.engine:
+            out, train_out = self.engine_forward(model, img)
+        elif self.jit:
+            out, train_out = self.jit_forward(img)
+        else:
+            with torch.cuda.amp.autocast(enabled=self.half):
+                out, train_out = model(img, augment=self.augment)  # inference and training outputs
         self.dt[1] += time_sync() - t2
 
         # Compute loss
         if compute_loss:
-            self.total_loss += compute_loss(train_out, targets, masks)[1]  # box, obj, cls
+            # box, obj, cls, summed in `reduce_loss`
+            self.loss_chunks.append(compute_loss(train_out, targets, masks)[1].detach())
 
         # Run NMS
-        targets[:, 2:] *= torch.Tensor([width, height, width, height]).to(self.device)  # to pixels
+        key = (height, width, self.device)
+        scale = self.scale_cache.get(key)
+        if scale is None:
+            scale = torch.tensor(
+                [width, height, width, height], device=self.device, dtype=targets.dtype
+            )
+            self.scale_cache[key] = scale
+        targets[:, 2:] *= scale  # to pixels
         t3 = time_sync()
         out = self.nms(
             prediction=out,
@@ -374,6 +543,28 @@ class Yolov5Evaluator:
         self.dt[2] += time_sync() - t3
         return out, train_out
 
+    def engine_forward(self, model, img):
+        """Forward with TensorRT engine, pad the last batch to the static batch size of engine."""
+        n = img.shape[0]
+        img = pad_batch(img, model.bindings["images"].shape[0])
+        out, train_out = model(img.contiguous(), val=True)
+        return out[:n], train_out
+
+    def jit_forward(self, img):
+        """Forward with the model traced in `before_infer`, pad the last batch to the traced batch size."""
+        n = img.shape[0]
+        out, train_out = self.jit_model(pad_batch(img, self.jit_batch_size))
+        return out[:n], train_out
+
+    def reduce_loss(self):
+        """Sum the loss items of all batches at once, rather than accumulating every batch."""
+        self.total_loss = (
+            torch.stack(self.loss_chunks, 0).sum(0)
+            if len(self.loss_chunks)
+            else torch.zeros((4 if self.mask else 3), device=self.device)
+        )
+        self.loss_chunks = []
+
     def after_infer(self):
         """Do something after inference, such as plots and get metrics.
         Return:
@@ -384,8 +575,19 @@ class Yolov5Evaluator:
             self.confusion_matrix.plot(save_dir=self.save_dir, names=list(self.names.values()))
 
         # Compute statistics
-        stats = [np.concatenate(x, 0) for x in zip(*self.stats)]  # to numpy
-        box_or_mask_any = stats[0].any() or stats[1].any()
+        if self.device.type != "cpu":
+            torch.cuda.synchronize(self.device)  # wait for `to_cpu_async`
+        stats = [
+            np.concatenate(x, 0)
+            for x in (
+                self.stats_masks,
+                self.stats_boxes,
+                self.stats_conf,
+                self.stats_pcls,
+                self.stats_tcls,
+            )
+        ] if len(self.stats_tcls) else []  # to numpy
+        box_or_mask_any = len(stats) and (stats[0].any() or stats[1].any())
         stats = stats[1:] if not self.mask else stats
         if len(stats) and box_or_mask_any:
             results = self.ap_per_class(
@@ -393,13 +595,13 @@ class Yolov5Evaluator:
             )
             self.metric.update(results)
             nt = np.bincount(
-                stats[(3 if not self.mask else 4)].astype(np.int64), minlength=self.nc
+                stats[(3 if not self.mask else 4)].astype(np.int64, copy=False), minlength=self.nc
             )  # number of targets per class
         else:
             nt = torch.zeros(1)
 
         # make this empty, cause make `stats` self is for reduce some duplicated codes.
-        self.stats = []
+        self.reset_stats()
         # print information
         self.print_metric(nt, stats)
         t = tuple(x / self.seen * 1e3 for x in self.dt)  # speeds per image
@@ -414,32 +616,41 @@ class Yolov5Evaluator:
         Returns:
             correct (Array[N, 10]), for 10 IoU levels
         """
+        det_img_ids = torch.zeros(detections.shape[0], device=detections.device)
+        lbl_img_ids = torch.zeros(labels.shape[0], device=labels.device)
+        return self.process_batch_vectorized(detections, labels, det_img_ids, lbl_img_ids, iouv)
+
+    def process_batch_vectorized(self, all_dets, all_labels, det_img_ids, lbl_img_ids, iouv):
+        """
+        Return correct predictions matrix of all images in a batch at once.
+        Both sets of boxes are in (x1, y1, x2, y2) format.
+        Arguments:
+            all_dets (Array[N, 6]), x1, y1, x2, y2, conf, class
+            all_labels (Array[M, 5]), class, x1, y1, x2, y2
+            det_img_ids (Array[N]), image index of each detection
+            lbl_img_ids (Array[M]), image index of each label
+        Returns:
+            correct (Array[N, 10]), for 10 IoU levels
+        """
         correct = torch.zeros(
-            detections.shape[0], iouv.shape[0], dtype=torch.bool, device=iouv.device
+            all_dets.shape[0], iouv.shape[0], dtype=torch.bool, device=iouv.device
         )
-        iou = box_iou(labels[:, 1:], detections[:, :4])
+        iou = box_iou(all_labels[:, 1:], all_dets[:, :4])
         x = torch.where(
-            (iou >= iouv[0]) & (labels[:, 0:1] == detections[:, 5])
-        )  # IoU above threshold and classes match
+            (iou >= iouv[0])
+            & (all_labels[:, 0:1] == all_dets[:, 5])
+            & (lbl_img_ids[:, None] == det_img_ids[None, :])
+        )  # IoU above threshold, classes match and in the same image
         if x[0].shape[0]:
-            matches = (
-                torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()
-            )  # [label, detection, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            matches = torch.Tensor(matches).to(iouv.device)
-            correct[matches[:, 1].long()] = matches[:, 2:3] >= iouv
+            self.match(iou, x, correct, iouv)
         return correct
 
-    def process_batch_masks(self, predn, proto_out, gt_masksi, labels):
+    def process_batch_masks(self, predn, proto_out, gt_masksi, labels, pred_maski=None):
         assert not (
             (proto_out is None) ^ (gt_masksi is None)
         ), "`proto_out` and `gt_masksi` should be both None or both exist."
-        if proto_out is None and gt_masksi is None:
-            return torch.zeros(0, self.niou, dtype=torch.bool), None
+        if (proto_out is None and gt_masksi is None) or predn.shape[0] == 0:
+            return torch.zeros(0, self.niou, dtype=torch.bool, device=predn.device), None
 
         correct = torch.zeros(
             predn.shape[0], self.iouv.shape[0], dtype=torch.bool, device=self.iouv.device
@@ -449,13 +660,14 @@ class Yolov5Evaluator:
             gt_masksi.shape[1] * self.mask_downsample_ratio,
             gt_masksi.shape[2] * self.mask_downsample_ratio,
         )
-        pred_maski = (
-            process(proto_out, predn[:, 6:], predn[:, :4], shape=gt_shape)
-            .permute(2, 0, 1)
-            .contiguous()
-        )
+        if pred_maski is None:
+            pred_maski = (
+                process(proto_out, predn[:, 6:], predn[:, :4], shape=gt_shape)
+                .permute(2, 0, 1)
+                .contiguous()
+            )
 
-        if not self.plots:
+        if not self.plots and gt_masksi.shape[1:] != pred_maski.shape[1:]:
             gt_masksi = F.interpolate(
                 gt_masksi.unsqueeze(0),
                 pred_maski.shape[1:],
@@ -470,39 +682,71 @@ class Yolov5Evaluator:
             (iou >= self.iouv[0]) & (labels[:, 0:1] == predn[:, 5])
         )  # IoU above threshold and classes match
         if x[0].shape[0]:
-            matches = (
-                torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()
-            )  # [label, detection, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            matches = torch.Tensor(matches).to(self.iouv.device)
-            correct[matches[:, 1].long()] = matches[:, 2:3] >= self.iouv
+            self.match(iou, x, correct, self.iouv)
         return correct, pred_maski
 
-    def compute_stat(self, si, predn, targets, gt_masks, train_out):
-        """Compute states about ious. with boxs size in training img-size space."""
-        labels = targets[targets[:, 0] == si, 1:]
-        # if there is `proto_out`(train_out[1]) and gt_masks is not None,
-        # then masks exist, or there is no masks.
-        masksi = gt_masks if gt_masks is None else gt_masks[targets[:, 0] == si]
-        proto_out = train_out[1][si] if isinstance(train_out, tuple) else None
+    def match(self, iou, x, correct, iouv):
+        """
+        Update correct predictions matrix with the matched pairs, all on the device of `iou`.
+        Every label and every detection is matched at most once, highest iou first.
+        Arguments:
+            iou (Array[M, N]), iou between labels and detections
+            x (Tuple[Array[K], Array[K]]), label and detection indexes of candidate pairs
+            correct (Array[N, 10]), for 10 IoU levels
+        Returns:
+            correct (Array[N, 10]), updated in place
+        """
+        li, di = x  # label, detection
+        v = iou[li, di]
+        if match_unique is not None and iou.device.type == "cpu":
+            correct[:] = torch.from_numpy(
+                match_unique(li.numpy(), di.numpy(), v.float().numpy(), iouv.numpy(), correct.shape[0])
+            )
+            return correct
+        if li.shape[0] > 1:
+            k = argsort_descending(v)
+            li, di, v = li[k], di[k], v[k]
+            k = unique_first(di)
+            li, di, v = li[k], di[k], v[k]
+            k = unique_first(li)
+            li, di, v = li[k], di[k], v[k]
+        correct[di] = v[:, None] >= iouv
+        return correct
+
+    def split_targets(self, targets, gt_masks, n):
+        """Split targets and masks of a batch into the ones of every image,
+        with one sort on image index instead of a `targets[:, 0] == si` scan for every image.
+        Return:
+            labels(List[Tensor]): [nl, 5] for every image, class, x, y, w, h.
+            masks(List[Tensor] | List[None]): [nl, h, w] for every image.
+        """
+        order = torch.argsort(targets[:, 0])
+        targets = targets[order]
+        boundaries = torch.searchsorted(
+            targets[:, 0].contiguous(),
+            torch.arange(n + 1, device=targets.device, dtype=targets.dtype),
+        ).tolist()
+        labels = [targets[boundaries[si] : boundaries[si + 1], 1:] for si in range(n)]
+        if gt_masks is None:
+            return labels, [None] * n
+        gt_masks = gt_masks[order]
+        masks = [gt_masks[boundaries[si] : boundaries[si + 1]] for si in range(n)]
+        return labels, masks
+
+    def compute_stat(self, si, predn, labels, masksi):
+        """Compute states about ious. with boxs size in training img-size space.
+        Boxes and masks are matched in `compute_batch_stat` for all images of the batch at once."""
 
         nl = len(labels)
-        tcls = labels[:, 0].tolist() if nl else []  # target class
 
         if len(predn) == 0:
             if nl:
-                self.stats.append(
-                    (
-                        torch.zeros(0, self.niou, dtype=torch.bool),  # boxes
-                        torch.zeros(0, self.niou, dtype=torch.bool),  # masks
-                        torch.Tensor(),
-                        torch.Tensor(),
-                        tcls,
-                    )
+                self.update_stats(
+                    torch.zeros(0, self.niou, dtype=torch.bool),  # masks
+                    torch.zeros(0, self.niou, dtype=torch.bool),  # boxes
+                    torch.Tensor(),
+                    torch.Tensor(),
+                    to_cpu_async(labels[:, 0].long()),  # target class
                 )
             return
 
@@ -514,51 +758,118 @@ class Yolov5Evaluator:
         if nl:
             tbox = xywh2xyxy(labels[:, 1:5])  # target boxes
             labelsn = torch.cat((labels[:, 0:1], tbox), 1)  # native-space labels
-            # boxes
-            correct_boxes = self.process_batch(predn, labelsn, self.iouv)
-
-            # masks
-            correct_masks, pred_maski = self.process_batch_masks(predn, proto_out, masksi, labelsn)
 
             if self.plots:
                 self.confusion_matrix.process_batch(predn, labelsn)
-                # TODO
-                if pred_maski is not None:
-                    self.pred_masks.append(pred_maski)
         else:
-            correct_boxes = torch.zeros(predn.shape[0], self.niou, dtype=torch.bool)
-            correct_masks = torch.zeros(predn.shape[0], self.niou, dtype=torch.bool)
-        self.stats.append(
-            (
-                correct_masks.cpu(),
-                correct_boxes.cpu(),
-                predn[:, 4].cpu(),
-                predn[:, 5].cpu(),
-                tcls,
+            labelsn = labels  # empty, [0, 5]
+        self.batch_dets.append(predn)
+        self.batch_labels.append(labelsn)
+        self.batch_stats.append((si, masksi))
+
+    def compute_batch_stat(self, gt_masks, train_out):
+        """Match boxes and masks of all images collected by `compute_stat` at once."""
+        if not len(self.batch_dets):
+            return
+        det_img_ids = torch.cat(
+            [
+                torch.full((len(d),), si, dtype=torch.long, device=d.device)
+                for d, (si, _) in zip(self.batch_dets, self.batch_stats)
+            ]
+        )
+        lbl_img_ids = torch.cat(
+            [
+                torch.full((len(l),), si, dtype=torch.long, device=l.device)
+                for l, (si, _) in zip(self.batch_labels, self.batch_stats)
+            ]
+        )
+        all_dets = torch.cat(self.batch_dets, 0)
+        all_labels = torch.cat(self.batch_labels, 0)
+        # boxes
+        correct_boxes = self.process_batch_vectorized(
+            all_dets, all_labels, det_img_ids, lbl_img_ids, self.iouv
+        )
+        # masks
+        correct_masks = self.compute_batch_masks(all_dets, det_img_ids, gt_masks, train_out)
+        tcls = all_labels[:, 0].long()  # target class
+        # one stat for the whole batch, copied to cpu without sync.
+        self.update_stats(
+            to_cpu_async(correct_masks),
+            to_cpu_async(correct_boxes),
+            to_cpu_async(all_dets[:, 4]),
+            to_cpu_async(all_dets[:, 5]),
+            to_cpu_async(tcls),
+        )
+        self.batch_dets = []
+        self.batch_labels = []
+        self.batch_stats = []
+
+    def compute_batch_masks(self, all_dets, det_img_ids, gt_masks, train_out):
+        """Match masks of all images collected by `compute_stat`,
+        masks of all detections are generated at once without `self.plots`."""
+        # if there is `proto_out`(train_out[1]) and gt_masks is not None,
+        # then masks exist, or there is no masks.
+        proto_out = train_out[1] if isinstance(train_out, tuple) else None
+        assert not (
+            (proto_out is None) ^ (gt_masks is None)
+        ), "`proto_out` and `gt_masks` should be both None or both exist."
+        if proto_out is None and gt_masks is None:
+            return torch.zeros(0, self.niou, dtype=torch.bool, device=all_dets.device)
+
+        pred_masks = [None] * len(self.batch_dets)
+        # only detections of images with labels are matched
+        keep = [i for i, labelsn in enumerate(self.batch_labels) if len(labelsn)]
+        if not self.plots and len(keep):
+            # full size masks for plotting are generated per image in `process_batch_masks`.
+            gt_shape = (
+                gt_masks.shape[1] * self.mask_downsample_ratio,
+                gt_masks.shape[2] * self.mask_downsample_ratio,
             )
-        )  # (correct, conf, pcls, tcls)
+            sizes = [len(d) for d in self.batch_dets]
+            img_ids = det_img_ids.split(sizes)
+            img_ids = torch.cat([img_ids[i] for i in keep])
+            dets = torch.cat([self.batch_dets[i] for i in keep], 0)
+            masks = process_masks_batched(
+                proto_out, dets[:, 6:], dets[:, :4], img_ids, gt_shape
+            ).split([sizes[i] for i in keep])
+            for i, m in zip(keep, masks):
+                pred_masks[i] = m
+
+        correct_masks = []
+        for predn, labelsn, pred_maski, (si, masksi) in zip(
+            self.batch_dets, self.batch_labels, pred_masks, self.batch_stats
+        ):
+            if len(labelsn):
+                correct, pred_maski = self.process_batch_masks(
+                    predn, proto_out[si], masksi, labelsn, pred_maski
+                )
+                if self.plots:
+                    # TODO
+                    self.pred_masks.append(pred_maski.bool())  # 0/1, kept until plotting
+            else:
+                correct = torch.zeros(
+                    predn.shape[0], self.niou, dtype=torch.bool, device=predn.device
+                )
+            correct_masks.append(correct)
+        return torch.cat(correct_masks, 0)
 
-    def compute_stat_native(self, si, img, predn, targets, gt_masks, train_out, shape, ratio_pad):
+    def compute_stat_native(self, si, img, predn, labels, masksi, train_out, shape, ratio_pad):
         """Compute states about ious. with boxs size in native space."""
-        labels = targets[targets[:, 0] == si, 1:]
-        # if there is `proto_out`(train_out[1]) and gt_masks is not None,
+        # if there is `proto_out`(train_out[1]) and masksi is not None,
         # then masks exist, or there is no masks.
-        masksi = gt_masks if gt_masks is None else gt_masks[targets[:, 0] == si]
         proto_out = train_out[1][si] if isinstance(train_out, tuple) else None
 
         nl = len(labels)
-        tcls = labels[:, 0].tolist() if nl else []  # target class
+        tcls = labels[:, 0].long().cpu()  # target class
 
         if len(predn) == 0:
             if nl:
-                self.stats.append(
-                    (
-                        torch.zeros(0, self.niou, dtype=torch.bool),  # boxes
-                        torch.zeros(0, self.niou, dtype=torch.bool),  # masks
-                        torch.Tensor(),
-                        torch.Tensor(),
-                        tcls,
-                    )
+                self.update_stats(
+                    torch.zeros(0, self.niou, dtype=torch.bool),  # masks
+                    torch.zeros(0, self.niou, dtype=torch.bool),  # boxes
+                    torch.Tensor(),
+                    torch.Tensor(),
+                    tcls,
                 )
             return
 
@@ -582,19 +893,32 @@ class Yolov5Evaluator:
                 self.confusion_matrix.process_batch(predn, labelsn)
                 # TODO
                 if pred_maski is not None:
-                    self.pred_masks.append(pred_maski)
+                    self.pred_masks.append(pred_maski.bool())  # 0/1, kept until plotting
         else:
             correct_boxes = torch.zeros(predn.shape[0], self.niou, dtype=torch.bool)
             correct_masks = torch.zeros(predn.shape[0], self.niou, dtype=torch.bool)
-        self.stats.append(
-            (
-                correct_masks.cpu(),
-                correct_boxes.cpu(),
-                predn[:, 4].cpu(),
-                predn[:, 5].cpu(),
-                tcls,
-            )
-        )  # (correct, conf, pcls, tcls)
+        self.update_stats(
+            correct_masks.cpu(),
+            correct_boxes.cpu(),
+            predn[:, 4].cpu(),
+            predn[:, 5].cpu(),
+            tcls,
+        )
+
+    def update_stats(self, correct_masks, correct_boxes, conf, pcls, tcls):
+        """Append one stat to the per-field lists, (correct_masks, correct_boxes, conf, pcls, tcls)."""
+        self.stats_masks.append(correct_masks)
+        self.stats_boxes.append(correct_boxes)
+        self.stats_conf.append(conf)
+        self.stats_pcls.append(pcls)
+        self.stats_tcls.append(tcls)
+
+    def reset_stats(self):
+        self.stats_masks = []
+        self.stats_boxes = []
+        self.stats_conf = []
+        self.stats_pcls = []
+        self.stats_tcls = []
 
     def print_metric(self, nt, stats):
         # Print results
@@ -610,14 +934,21 @@ class Yolov5Evaluator:
     def plot_images(self, i, img, targets, masks, out, paths):
         if (not self.plots) or i >= 3 or (not self.save_dir.exists()):
             return
+        # only numpy arrays are sent to the plotting processes,
+        # `img` is the uint8 batch of dataloader, keep it uint8 rather than pickling 4x float.
+        img = img.cpu().numpy()
         # plot ground truth
         f = self.save_dir / f"val_batch{i}_labels.jpg"  # labels
-
-        Thread(
-            target=plot_images_boxes_and_masks,
-            args=(img, targets, masks, paths, f, self.names, max(img.shape[2:])),
-            daemon=True,
-        ).start()
+        plot_pool().submit(
+            plot_images_boxes_and_masks,
+            img,
+            targets.cpu().numpy(),
+            masks if masks is None else masks.cpu().numpy(),
+            paths,
+            f,
+            self.names,
+            max(img.shape[2:]),
+        ).add_done_callback(plot_done)
         f = self.save_dir / f"val_batch{i}_pred.jpg"  # predictions
 
         # plot predition
@@ -626,14 +957,19 @@ class Yolov5Evaluator:
                 torch.cat(self.pred_masks, dim=0)
                 if len(self.pred_masks) > 1
                 else self.pred_masks[0]
-            )
+            ).cpu().numpy()
         else:
             pred_masks = None
-        Thread(
-            target=plot_images_boxes_and_masks,
-            args=(img, output_to_target(out), pred_masks, paths, f, self.names, max(img.shape[2:])),
-            daemon=True,
-        ).start()
+        plot_pool().submit(
+            plot_images_boxes_and_masks,
+            img,
+            output_to_target(out),
+            pred_masks,
+            paths,
+            f,
+            self.names,
+            max(img.shape[2:]),
+        ).add_done_callback(plot_done)
 
     def nms(self, **kwargs):
         return non_max_suppression_masks(**kwargs) if self.mask else non_max_suppression(**kwargs)
@@ -1,3 +1,4 @@
 from .data_reader import LoadImages, LoadStreams, LoadWebcam
 from .datasets import LoadImagesAndLabels, LoadImagesAndLabelsAndMasks, create_dataloader, create_dataloader_ori
 from .augmentations import letterbox
+from .dataloadering import CUDAPrefetcher
@@ -1,3 +1,4 @@
+import torch
 from torch.utils.data import DataLoader as torchDataLoader
 from .samplers import _RepeatSampler
 
@@ -34,3 +35,48 @@ class InfiniteDataLoader(torchDataLoader):
         for i in range(len(self)):
             yield next(self.iterator)
 
+
+
+class CUDAPrefetcher:
+    """Copy the next batch to cuda in a side stream while the current batch is computed.
+    The tensors of the batch should be in pinned memory, see `pin_memory` of the dataloader.
+    Check more on the following website:
+    https://github.com/NVIDIA/apex/blob/master/examples/imagenet/main_amp.py
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = [
+                x.to(self.device, non_blocking=True) if isinstance(x, torch.Tensor) else x
+                for x in batch
+            ]
+
+    def __next__(self):
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        for x in batch:
+            if isinstance(x, torch.Tensor):
+                # memory allocated in `self.stream` is used by the current stream now.
+                x.record_stream(torch.cuda.current_stream(self.device))
+        self.preload()
+        return batch
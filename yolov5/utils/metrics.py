@@ -12,6 +12,11 @@ import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
+try:
+    from numba import njit  # for `match_unique`
+except ImportError:
+    njit = None
+
 
 def fitness(x, masks=False):
     # Model fitness as a weighted combination of metrics
@@ -404,6 +409,38 @@ def wh_iou(wh1, wh2):
     )  # iou = inter / (area1 + area2 - inter)
 
 
+def _match_unique(labels, detections, iou, iouv, n):
+    """
+    Return correct predictions matrix of the matched pairs,
+    every detection is matched to the label with highest iou, then every label to its first detection.
+    Arguments:
+        labels (Array[K]), label index of candidate pairs
+        detections (Array[K]), detection index of candidate pairs
+        iou (Array[K]), iou of candidate pairs
+        iouv (Array[10]), iou thresholds
+        n (int), number of detections
+    Returns:
+        correct (Array[n, 10]), for 10 IoU levels
+    """
+    correct = np.zeros((n, iouv.shape[0]), dtype=np.bool_)
+    best = np.full(n, -1, dtype=np.int64)  # best pair of every detection
+    # highest iou first, ties by index descending as `np.argsort(iou, kind="stable")[::-1]`
+    for k in iou.shape[0] - 1 - np.argsort(-iou[::-1], kind="mergesort"):
+        if best[detections[k]] < 0:
+            best[detections[k]] = k
+    seen = np.zeros(labels.max() + 1, dtype=np.bool_)
+    for d in range(n):
+        k = best[d]
+        if k >= 0 and not seen[labels[k]]:
+            seen[labels[k]] = True
+            correct[d] = iou[k] >= iouv
+    return correct
+
+
+# None if numba is not installed
+match_unique = njit(cache=True)(_match_unique) if njit is not None else None
+
+
 # Plots ----------------------------------------------------------------------------------------------------------------
 
 
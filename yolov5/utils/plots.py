@@ -259,8 +259,8 @@ def plot_images(
         images = images.cpu().float().numpy()
     if isinstance(targets, torch.Tensor):
         targets = targets.cpu().numpy()
-    if np.max(images[0]) <= 1:
-        images *= 255.0  # de-normalise (optional)
+    if images.dtype != np.uint8 and np.max(images[0]) <= 1:
+        images *= 255.0  # de-normalise (optional), uint8 images are never normalised
     bs, _, h, w = images.shape  # batch size, _, height, width
     bs = min(bs, max_subplots)  # limit plot images
     ns = np.ceil(bs ** 0.5)  # number of subplots (square)
@@ -716,7 +716,7 @@ def plot_images_and_masks(
         masks = masks.astype(int)
 
     # un-normalise
-    if np.max(images[0]) <= 1:
+    if images.dtype != np.uint8 and np.max(images[0]) <= 1:
         images *= 255
 
     tl = 3  # line thickness
@@ -772,7 +772,7 @@ def plot_images_and_masks(
                 cls = int(classes[j])
                 color = colors(cls)
                 cls = names[cls] if names else cls
-                mask = image_masks[j].astype(np.bool)
+                mask = image_masks[j].astype(bool)
                 # print(mask.shape)
                 # print(mosaic.shape)
                 if labels or conf[j] > 0.25:  # 0.25 conf thresh
@@ -249,6 +249,51 @@ def process_mask(proto_out, out_masks, bboxes, shape, upsample=False):
         masks = F.interpolate(masks.unsqueeze(0), shape, mode='bilinear', align_corners=False).squeeze(0)
     return masks.gt_(0.5).permute(1, 2, 0).contiguous()
 
+def process_masks_batched(proto_out, out_masks, bboxes, img_ids, shape, chunk=4):
+    """
+    Crop before unsample, same as `process_mask` but for all images of a batch at once.
+    proto_out: [bs, mask_dim, mask_h, mask_w]
+    out_masks: [n, mask_dim], n is number of masks after nms of all images
+    bboxes: [n, 4], n is number of masks after nms of all images
+    img_ids: [n], sorted image index of each mask
+    shape:input_image_size, (h, w)
+    chunk: number of images projected at once, bounds the [chunk, max_n, mask_h * mask_w] buffer
+
+    return: n, mask_h, mask_w, bool
+    """
+    bs, mask_dim, mh, mw = proto_out.shape
+    ih, iw = shape
+    n = img_ids.shape[0]
+    masks = torch.zeros(n, mh, mw, dtype=torch.bool, device=proto_out.device)
+    if n == 0:
+        return masks
+    counts = torch.bincount(img_ids, minlength=bs)
+    ends = counts.cumsum(0)
+    # index of each mask in its own image
+    idx = torch.arange(n, device=img_ids.device) - (ends - counts)[img_ids]
+    coefs_all = out_masks.float().tanh()
+    proto = proto_out.float().reshape(bs, mask_dim, -1)
+    # crop, [n, 1, 1] each
+    boxes = bboxes.float() * bboxes.new_tensor([mw / iw, mh / ih, mw / iw, mh / ih]).float()
+    rows = torch.arange(mw, device=masks.device, dtype=boxes.dtype).view(1, 1, -1)
+    cols = torch.arange(mh, device=masks.device, dtype=boxes.dtype).view(1, -1, 1)
+
+    counts = counts.tolist()
+    ends = [0] + ends.tolist()
+    for i in range(0, bs, chunk):
+        j = min(i + chunk, bs)
+        s, e = ends[i], ends[j]
+        if s == e:
+            continue
+        ids, k = img_ids[s:e] - i, idx[s:e]
+        coefs = torch.zeros(j - i, max(counts[i:j]), mask_dim, device=coefs_all.device)
+        coefs[ids, k] = coefs_all[s:e]
+        # [chunk, max_n, mask_dim] @ [chunk, mask_dim, mask_h * mask_w], sigmoid(x) > 0.5 is x > 0
+        m = (torch.bmm(coefs, proto[i:j]) > 0)[ids, k].view(-1, mh, mw)
+        x1, y1, x2, y2 = boxes[s:e, :, None, None].unbind(1)
+        masks[s:e] = m & (rows >= x1) & (rows < x2) & (cols >= y1) & (cols < y2)
+    return masks
+
 def scale_masks(img1_shape, masks, img0_shape, ratio_pad=None):
     """
     img1_shape: model input shape, [h, w]
@@ -284,22 +329,24 @@ def scale_masks(img1_shape, masks, img0_shape, ratio_pad=None):
 
     return masks
 
-def mask_iou(mask1, mask2):
+def mask_iou(mask1, mask2, eps=1e-7):
     """
-    mask1: [N, n] m1 means number of predicted objects 
-    mask2: [M, n] m2 means number of gt objects
-    Note: n means image_w x image_h
+    mask1: [N, n] m1 means number of gt objects
+    mask2: [M, n] m2 means number of predicted objects
+    Note: n means image_w x image_h, bool masks are cast to float for the matmul
+
+    Intersection is one matmul(cuBLAS) rather than a [N, M, n] elementwise reduction,
+    unions are got from the areas, so no [N, M, n] intermediate is created.
 
     return: masks iou, [N, M]
     """
-    # print(mask1.shape)
-    # print(mask2.shape)
+    mask1, mask2 = mask1.float(), mask2.float()
     intersection = torch.matmul(mask1, mask2.t()).clamp(0)
-    area1 = torch.sum(mask1, dim=1).view(1, -1)
-    area2 = torch.sum(mask2, dim=1).view(1, -1)
-    union = (area1.t() + area2) - intersection
+    area1 = mask1.sum(1)[:, None]  # (N, 1)
+    area2 = mask2.sum(1)[None]  # (1, M)
+    union = area1 + area2 - intersection
 
-    return intersection / (union + 1e-7)
+    return intersection / (union + eps)
 
 def masks_iou(mask1, mask2):
     """
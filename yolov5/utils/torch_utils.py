@@ -83,6 +83,11 @@ def select_device(device='', batch_size=None):
     return torch.device('cuda:0' if cuda else 'cpu')
 
 
+def inference_mode():
+    # torch.inference_mode() for torch>=1.9, or torch.no_grad()
+    return torch.inference_mode() if hasattr(torch, "inference_mode") else torch.no_grad()
+
+
 def time_sync():
     # pytorch-accurate time
     if torch.cuda.is_available():